@@ -1,10 +1,20 @@
+import io
 import os
+import re
+import time
+import heapq
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for, session
 from werkzeug.middleware.proxy_fix import ProxyFix
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+import orjson
 import pandas as pd
 from scraper import PaymentDataScraper
-import tempfile
 import uuid
 from urllib.parse import urlparse
 
@@ -22,25 +32,109 @@ scraper = PaymentDataScraper()
 # In-memory data store to avoid large session cookies
 session_data_store = {}
 
+# Background pool for scrape jobs, so /scrape returns without waiting on the fetch
+executor = ThreadPoolExecutor(max_workers=8)
+
+# Scrape jobs not yet collected by /scrape_status: session_id -> {'future', 'url', 'started'}
+scrape_jobs = {}
+
+# Min-heap of (started, session_id), one entry per submitted scrape job
+_job_heap = []
+_jobs_lock = threading.Lock()
+
+# Session ids whose finished job a /scrape_status poll is storing right now
+_collecting_jobs = set()
+
+# Columns the preview page is allowed to edit via /update_data
+ALLOWED_UPDATE_KEYS = frozenset({
+    'Principal_PassBook', 'Principal_Variance', 'Principal_Remarks',
+    'CBU_PassBook', 'CBU_Variance', 'CBU_Remarks',
+    'CBU_withdraw_PassBook', 'CBU_withdraw_Variance', 'CBU_withdraw_Remarks',
+})
+
+# Sessions expire 2 hours after they were last stored
+SESSION_TTL = 7200
+
+# Min-heap of (expires_at, session_id), one entry per stored session
+_expiry_heap = []
+_expiry_lock = threading.Lock()
+
+def _purge_expired_sessions(current_time):
+    """Drop sessions whose TTL has passed, popping only heap entries that are due."""
+    while _expiry_heap and _expiry_heap[0][0] <= current_time:
+        _, session_id = heapq.heappop(_expiry_heap)
+        stored = session_data_store.get(session_id)
+        if stored is None:
+            continue
+        expires_at = stored.get('timestamp', 0) + SESSION_TTL
+        if expires_at <= current_time:
+            del session_data_store[session_id]
+        else:
+            # Refreshed since this entry was pushed; reschedule it
+            heapq.heappush(_expiry_heap, (expires_at, session_id))
+
 def store_session_data(session_id, data):
     """Store data in server-side storage instead of session cookie"""
-    import time
-    # Clean old sessions (older than 2 hours)
     current_time = time.time()
-    expired = [k for k, v in session_data_store.items() if current_time - v.get('timestamp', 0) > 7200]
-    for k in expired:
-        del session_data_store[k]
-    
-    session_data_store[session_id] = {
-        'data': data,
-        'timestamp': current_time
-    }
+    with _expiry_lock:
+        _purge_expired_sessions(current_time)
+        
+        if session_id not in session_data_store:
+            heapq.heappush(_expiry_heap, (current_time + SESSION_TTL, session_id))
+        session_data_store[session_id] = {
+            'data': data,
+            'timestamp': current_time
+        }
+
+def touch_session(session_id):
+    """Refresh a session's expiry after its stored data was modified in place"""
+    stored = session_data_store.get(session_id)
+    if stored:
+        stored['timestamp'] = time.time()
+
+def _purge_stale_jobs(current_time):
+    """Forget scrape jobs whose waiting page was abandoned before they were collected"""
+    while _job_heap and _job_heap[0][0] + SESSION_TTL <= current_time:
+        _, session_id = heapq.heappop(_job_heap)
+        scrape_jobs.pop(session_id, None)
 
 def get_session_data(session_id):
     """Retrieve data from server-side storage"""
     stored = session_data_store.get(session_id)
     return stored['data'] if stored else None
 
+DIGIT_RE = re.compile(r'\d')
+
+# Sort position for rows whose date can't be parsed: at the beginning
+UNPARSED_DATE = pd.Timestamp(1900, 1, 1)
+
+def _parse_dates(dates):
+    """Parse date strings to naive timestamps, NaT where a value can't be parsed."""
+    # utc=True lets tz-aware and naive values share one pass; dropping the
+    # timezone afterwards keeps every key comparable with UNPARSED_DATE
+    parsed = pd.to_datetime(pd.Series(dates, dtype=object), errors='coerce', format='mixed', utc=True)
+    return parsed.dt.tz_convert(None)
+
+def assign_date_keys(rows):
+    """Parse the rows' Date values in one vectorized pass and cache each result as row['_date_key']."""
+    # Skip non-date strings like "April", "total", etc.
+    dates = [
+        date_str.strip() if isinstance(date_str, str) and DIGIT_RE.search(date_str) else None
+        for date_str in (row.get('Date') for row in rows)
+    ]
+    try:
+        parsed = _parse_dates(dates)
+    except (ValueError, TypeError, OverflowError):
+        # One bad value sinks the whole batch; retry row by row so only it goes unparsed
+        parsed = []
+        for date_str in dates:
+            try:
+                parsed.append(_parse_dates([date_str])[0])
+            except (ValueError, TypeError, OverflowError):
+                parsed.append(pd.NaT)
+    for row, date_key in zip(rows, parsed):
+        row['_date_key'] = UNPARSED_DATE if pd.isna(date_key) else date_key
+
 @app.route('/')
 def index():
     """Main page with URL input form."""
@@ -65,30 +159,85 @@ def scrape_url():
         flash('Invalid URL format', 'error')
         return redirect(url_for('index'))
     
-    try:
-        # Scrape the data
-        app.logger.info(f"Starting scrape for URL: {url}")
-        data = scraper.scrape_payment_data(url)
-        
-        if not data:
-            flash('No payment data found on the specified page', 'warning')
-            return redirect(url_for('index'))
+    # Scrape in the background so the request thread isn't tied up by the fetch
+    session_id = str(uuid.uuid4())
+    app.logger.info(f"Starting scrape for URL: {url}")
+    current_time = time.time()
+    with _jobs_lock:
+        _purge_stale_jobs(current_time)
         
-        # Store data in server-side storage to avoid large session cookies
-        session_id = str(uuid.uuid4())
-        store_session_data(session_id, {
-            'data': data,
+        heapq.heappush(_job_heap, (current_time, session_id))
+        scrape_jobs[session_id] = {
+            'future': executor.submit(scraper.scrape_payment_data, url),
             'url': url,
-            'columns': list(data[0].keys()) if data else []
-        })
-        
-        app.logger.info(f"Successfully scraped {len(data)} records")
-        return redirect(url_for('preview', session_id=session_id))
-        
+            'started': current_time
+        }
+    
+    return redirect(url_for('scraping', session_id=session_id))
+
+@app.route('/scraping/<session_id>')
+def scraping(session_id):
+    """Waiting page that polls the scrape job until it finishes."""
+    return render_template('scraping.html', session_id=session_id)
+
+@app.route('/scrape_status/<session_id>')
+def scrape_status(session_id):
+    """Report whether a scrape job is done, storing its data once it is."""
+    # Take the job out before looking at it, so concurrent polls can't both collect it
+    with _jobs_lock:
+        job = scrape_jobs.pop(session_id, None)
+        if job is not None and not job['future'].done():
+            scrape_jobs[session_id] = job
+            return jsonify({'done': False})
+        if job is None and session_id in _collecting_jobs:
+            # Another poll collected it and is still storing the data
+            return jsonify({'done': False})
+        if job is not None:
+            _collecting_jobs.add(session_id)
+    
+    if job is None:
+        if get_session_data(session_id):
+            return jsonify({'done': True, 'redirect': url_for('preview', session_id=session_id)})
+        flash('Session expired or invalid. Please scrape again.', 'error')
+        return jsonify({'done': True, 'redirect': url_for('index')}), 404
+    
+    try:
+        return _collect_job(session_id, job)
+    finally:
+        with _jobs_lock:
+            _collecting_jobs.discard(session_id)
+
+def _collect_job(session_id, job):
+    """Store a finished scrape job's data and tell the waiting page where to go next."""
+    future = job['future']
+    url = job['url']
+    
+    try:
+        data = future.result()
     except Exception as e:
         app.logger.error(f"Error scraping URL {url}: {str(e)}")
         flash(f'Error scraping data: {str(e)}', 'error')
-        return redirect(url_for('index'))
+        return jsonify({'done': True, 'redirect': url_for('index')})
+    
+    if not data:
+        flash('No payment data found on the specified page', 'warning')
+        return jsonify({'done': True, 'redirect': url_for('index')})
+    
+    # Take the columns before the internal _date_key is added to every row
+    columns = list(data[0].keys())
+    
+    # Parse all dates once up front so add_row can sort without re-parsing
+    assign_date_keys(data)
+    
+    # Store data in server-side storage to avoid large session cookies
+    store_session_data(session_id, {
+        'data': data,
+        'url': url,
+        'columns': columns
+    })
+    
+    app.logger.info(f"Successfully scraped {len(data)} records")
+    return jsonify({'done': True, 'redirect': url_for('preview', session_id=session_id)})
 
 @app.route('/preview/<session_id>')
 def preview(session_id):
@@ -118,21 +267,23 @@ def update_data(session_id):
         return jsonify({'error': 'Session expired'}), 400
     
     try:
-        update_data = request.get_json()
+        update_data = orjson.loads(request.get_data())
         data = scraped_info['data']
         
+        # Index rows by ID once so each update is a direct lookup
+        rows_by_id = {}
+        for row in data:
+            rows_by_id.setdefault(row.get('_row_id'), row)
+        
         # Update the data using row IDs instead of indices
         for row_id, updates in update_data.items():
-            # Find the row with matching ID
-            for row in data:
-                if row.get('_row_id') == row_id:
-                    for key, value in updates.items():
-                        if key in ['Principal_PassBook', 'Principal_Variance', 'Principal_Remarks', 'CBU_PassBook', 'CBU_Variance', 'CBU_Remarks', 'CBU_withdraw_PassBook', 'CBU_withdraw_Variance', 'CBU_withdraw_Remarks']:
-                            row[key] = str(value)
-                    break
+            row = rows_by_id.get(row_id)
+            if row is None:
+                continue
+            row.update({key: str(updates[key]) for key in updates.keys() & ALLOWED_UPDATE_KEYS})
         
-        # Update server-side storage
-        store_session_data(session_id, scraped_info)
+        # Data was edited in place; just keep the session alive
+        touch_session(session_id)
         return jsonify({'success': True})
         
     except Exception as e:
@@ -152,47 +303,41 @@ def download_excel(session_id):
         data = scraped_info['data']
         url = scraped_info['url']
         
-        # Create DataFrame with proper column ordering
+        # Preferred column ordering for the export
         column_order = ['Receipt No', 'Date', 'Principal', 'Pen', 'Principal_PassBook', 'Principal_Variance', 'Principal_Remarks',
                        'CBU', 'CBU_PassBook', 'CBU_Variance', 'CBU_Remarks', 'CBU withdraw', 'CBU_withdraw_PassBook', 'CBU_withdraw_Variance', 'CBU_withdraw_Remarks', 'Collector']
         
-        # Ensure all columns exist in the data
-        for row in data:
-            for col in column_order:
-                if col not in row:
-                    row[col] = ''
-        
-        # Create DataFrame and reorder columns
-        df = pd.DataFrame(data)
+        # Export every preferred column; rows missing one get an empty cell
+        # (read with row.get so the stored session rows are left untouched)
+        available_columns = column_order if data else []
         
-        # Reorder columns to match our preferred order
-        available_columns = [col for col in column_order if col in df.columns]
-        if available_columns:
-            df = df[available_columns]
+        # Auto-adjust column widths (write-only sheets need them before any row is appended)
+        max_len = [len(col) for col in available_columns]
+        for row in data:
+            for i, col in enumerate(available_columns):
+                max_len[i] = max(max_len[i], len(str(row.get(col, ''))))
+        
+        # Write to Excel with a write-only workbook, streaming rows straight to the sheet
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Payment Data')
+        for i, length in enumerate(max_len, start=1):
+            worksheet.column_dimensions[get_column_letter(i)].width = min(length + 2, 50)
+        
+        header_font = Font(bold=True)
+        header = []
+        for col in available_columns:
+            cell = WriteOnlyCell(worksheet, value=col)
+            cell.font = header_font
+            header.append(cell)
+        worksheet.append(header)
         
-        # Create temporary file
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx')
+        for row in data:
+            worksheet.append([row.get(col, '') for col in available_columns])
         
-        # Write to Excel with formatting
-        with pd.ExcelWriter(temp_file.name, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Payment Data', index=False)
-            
-            # Get workbook and worksheet for formatting
-            workbook = writer.book
-            worksheet = writer.sheets['Payment Data']
-            
-            # Auto-adjust column widths
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+        # Build the file in memory; nothing is left behind on disk
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        buffer.seek(0)
         
         # Generate filename
         domain = urlparse(url).netloc.replace('www.', '')
@@ -203,7 +348,7 @@ def download_excel(session_id):
         # Clean up server-side data after download
         session_data_store.pop(session_id, None)
         
-        return send_file(temp_file.name, 
+        return send_file(buffer, 
                         as_attachment=True, 
                         download_name=filename,
                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
@@ -222,63 +367,22 @@ def add_row(session_id):
         return jsonify({'error': 'Session expired'}), 400
     
     try:
-        new_row_data = request.get_json()
+        new_row_data = orjson.loads(request.get_data())
         data = scraped_info['data']
         
         # Add unique ID to the new row to prevent conflicts after sorting
-        import time
         new_row_data['_row_id'] = f"row_{int(time.time() * 1000)}"
         
-        # Add the new row to the data
-        data.append(new_row_data)
-        
-        # Sort by date (parse dates properly)
-        def parse_date(date_str):
-            try:
-                from datetime import datetime as dt
-                import re
-                
-                if not date_str or not isinstance(date_str, str):
-                    return dt(1900, 1, 1)
-                
-                date_str = date_str.strip()
-                
-                # Skip non-date strings like "April", "total", etc.
-                if not re.search(r'\d', date_str):
-                    return dt(1900, 1, 1)
-                
-                # Primary format should be MM/DD/YYYY to match our data
-                formats = [
-                    '%m/%d/%Y',     # MM/DD/YYYY (primary format)
-                    '%m-%d-%Y',     # MM-DD-YYYY
-                    '%d/%m/%Y',     # DD/MM/YYYY (fallback)
-                    '%d-%m-%Y',     # DD-MM-YYYY (fallback)
-                    '%Y-%m-%d',     # YYYY-MM-DD (fallback)
-                    '%Y/%m/%d',     # YYYY/MM/DD (fallback)
-                ]
-                
-                for fmt in formats:
-                    try:
-                        parsed_date = dt.strptime(date_str, fmt)
-                        app.logger.debug(f"Successfully parsed date '{date_str}' with format '{fmt}' -> {parsed_date}")
-                        return parsed_date
-                    except ValueError:
-                        continue
-                
-                # If no format works, return a very old date to put it at the beginning
-                app.logger.warning(f"Could not parse date: '{date_str}', placing at beginning")
-                return dt(1900, 1, 1)
-            except Exception as e:
-                app.logger.error(f"Error parsing date '{date_str}': {str(e)}")
-                from datetime import datetime as dt
-                return dt(1900, 1, 1)
+        # Always derive the sort key server-side, before the row joins the data
+        new_row_data.pop('_date_key', None)
+        assign_date_keys([new_row_data])
         
-        # Sort data by date
-        data.sort(key=lambda x: parse_date(x.get('Date', '')))
+        # Add the new row to the data and sort by the cached dates
+        data.append(new_row_data)
+        data.sort(key=lambda row: row['_date_key'])
         
-        # Update server-side storage with sorted data
-        scraped_info['data'] = data
-        store_session_data(session_id, scraped_info)
+        # Data was sorted in place; just keep the session alive
+        touch_session(session_id)
         
         app.logger.info(f"Added new row and sorted data. Total records: {len(data)}")
         return jsonify({'success': True, 'total_records': len(data)})
@@ -296,7 +400,7 @@ def delete_row(session_id):
         return jsonify({'error': 'Session expired'}), 400
     
     try:
-        request_data = request.get_json()
+        request_data = orjson.loads(request.get_data())
         row_id = request_data.get('row_id')
         
         if not row_id:
@@ -311,8 +415,8 @@ def delete_row(session_id):
         if len(scraped_info['data']) == original_length:
             return jsonify({'error': 'Row not found'}), 404
         
-        # Update server-side storage
-        store_session_data(session_id, scraped_info)
+        # Data was edited in place; just keep the session alive
+        touch_session(session_id)
         
         app.logger.info(f"Deleted row {row_id}. Total records: {len(scraped_info['data'])}")
         return jsonify({'success': True, 'total_records': len(scraped_info['data'])})
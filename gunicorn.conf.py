@@ -0,0 +1,16 @@
+"""Gunicorn settings for production: run with `gunicorn app:app`."""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# gevent workers patch sockets at startup, so outbound scrapes yield while waiting
+# and one worker keeps many requests in flight
+worker_class = 'gevent'
+worker_connections = 100
+
+# Scraped sessions and scrape jobs are held in process memory, so every
+# request for a session must reach the same worker process
+workers = 1
+
+# Scrapes run on the background pool, but leave headroom for slow uploads/downloads
+timeout = 120
@@ -1,16 +1,61 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4.dammit import EncodingDetector, UnicodeDammit
+from lxml import etree
 import re
+import codecs
+import itertools
 import logging
 from urllib.parse import urljoin, urlparse
 import time
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
+
+# Characters stripped from cell text by _clean_text
+_CLEAN_RE = re.compile(r'[^\w\s\$€£¥.,:\-/()%]')
+
+# Patterns a Date cell must match for the row to count as a data row
+_DATE_PATTERNS = [re.compile(p) for p in (
+    r'\d+[/\-\.]\d+[/\-\.]\d+',  # DD/MM/YYYY, MM-DD-YYYY etc
+    r'\d{4}[/\-\.]\d{1,2}[/\-\.]\d{1,2}',  # YYYY-MM-DD
+    r'\d{1,2}\s+\w{3,9}\s+\d{4}',  # DD Month YYYY
+    r'\w{3,9}\s+\d{1,2},?\s+\d{4}',  # Month DD, YYYY
+)]
+
+# Words that mark a table as payment data; at least 4 must appear
+_PAYMENT_INDICATORS = ('receipt', 'date', 'principal', 'collector', 'pen', 'cbu', 'payment', 'amount paid')
+
+# Row values containing any of these are summary/total rows
+_SUMMARY_RE = re.compile('|'.join(re.escape(keyword) for keyword in (
+    'total', 'subtotal', 'grand total', 'sum', 'summary', 'balance',
+)))
+
+# Month names; the three-letter forms also cover the full names
+_MONTH_RE = re.compile('jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec')
+
+# Decoders for byte-order marks, chosen so the BOM itself is consumed
+_BOM_CODECS = {'utf-8': 'utf-8-sig', 'utf-16le': 'utf-16', 'utf-16be': 'utf-16', 'utf-32le': 'utf-32', 'utf-32be': 'utf-32'}
+
+# End of the document head; no <meta> charset is looked for past it
+_HEAD_END_RE = re.compile(rb'</head\s*>|<body[\s>]', re.IGNORECASE)
+
+# Compiled XPath helpers for walking lxml table elements
+_text_content = etree.XPath('string()')
+_th_cells = etree.XPath('.//th')
+_td_cells = etree.XPath('.//td')
+_row_cells = etree.XPath('.//td|.//th')
+_key_value_elements = etree.XPath("//*[self::div or self::span or self::p][contains(., ':')]")
 
 class PaymentDataScraper:
     """Web scraper for extracting specific payment data columns: Date, Pen, Principal, CBU, CBU withdraw, Collector."""
     
     def __init__(self):
         self.session = requests.Session()
+        # Larger keep-alive pool plus a couple of retries for transient connection errors
+        adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20,
+                              max_retries=Retry(total=2, backoff_factor=0.3))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
@@ -35,17 +80,15 @@ class PaymentDataScraper:
         """
         try:
             self.logger.info(f"Fetching URL: {url}")
-            response = self.session.get(url, timeout=self.timeout)
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            # Extract data from tables (primary method)
-            payment_data = self._extract_from_tables(soup)
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                
+                # Extract data from tables (primary method) while the page downloads
+                tree, payment_data = self._extract_from_tables(response)
             
             # If no data found in tables, try other methods
-            if not payment_data:
-                payment_data.extend(self._extract_from_structured_content(soup))
+            if not payment_data and tree is not None:
+                payment_data.extend(self._extract_from_structured_content(tree))
             
             # Don't remove duplicates - preserve all records including date duplicates
             unique_data = payment_data
@@ -69,47 +112,131 @@ class PaymentDataScraper:
             self.logger.error(f"Scraping error for {url}: {str(e)}")
             raise Exception(f"Failed to scrape data: {str(e)}")
     
-    def _extract_from_tables(self, soup: BeautifulSoup) -> List[Dict[str, Any]]:
-        """Extract payment data from HTML tables."""
-        data = []
+    def _extract_from_tables(self, response: requests.Response) -> Tuple[Optional[etree._Element], List[Dict[str, Any]]]:
+        """
+        Extract payment data from HTML tables, parsing the response body as it streams in.
         
-        # Look for all tables
-        tables = soup.find_all('table')
+        Each table is processed as soon as its closing tag has been parsed and
+        freed once it has yielded rows; the results are put back in document
+        order, so a nested table's rows still follow those of the table that
+        contains it.
         
-        for table in tables:
-            table_data = self._process_table(table)
-            if table_data:
-                data.extend(table_data)
+        Returns:
+            The parsed document root (None for an empty page) and the extracted rows
+        """
+        parser = etree.HTMLPullParser(events=('start', 'end'), tag='table')
+        start_counter = itertools.count()
+        start_positions = {}
+        processed = []
         
-        return data
+        def process_closed_tables():
+            for event, table in parser.read_events():
+                if event == 'start':
+                    start_positions[table] = next(start_counter)
+                else:
+                    table_data = self._process_table(table)
+                    processed.append((start_positions.pop(table), table_data))
+                    # Once a table has yielded rows the key/value fallback won't run, so its
+                    # subtree can be freed; an enclosing table still needs its nested rows
+                    if table_data and not start_positions:
+                        table.clear(keep_tail=True)
+        
+        # The head is buffered until its charset is known, then fed through one decoder.
+        # A page that declares none is buffered whole and left to UnicodeDammit.
+        header_encoding = self._header_encoding(response)
+        head = b''
+        decoder = None
+        undeclared = False
+        
+        for chunk in response.iter_content(chunk_size=8192):
+            if decoder is None:
+                head += chunk
+                if undeclared:
+                    continue
+                encoding = self._sniff_encoding(head, header_encoding)
+                if encoding is None:
+                    undeclared = _HEAD_END_RE.search(head) is not None
+                    continue
+                decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+                chunk, head = head, b''
+            parser.feed(decoder.decode(chunk))
+            process_closed_tables()
+        
+        if decoder is None:
+            # Same detection BeautifulSoup applied before streaming
+            parser.feed(UnicodeDammit(head, is_html=True).unicode_markup or '')
+        else:
+            parser.feed(decoder.decode(b'', final=True))
+        tree = parser.close()
+        process_closed_tables()
+        
+        processed.sort(key=lambda item: item[0])
+        data = [row for _, table_data in processed for row in table_data]
+        return tree, data
+    
+    def _header_encoding(self, response: requests.Response) -> Optional[str]:
+        """Return the charset given in the Content-Type header, if there is one."""
+        # get_encoding_from_headers assumes ISO-8859-1 for text/* without a charset; only trust an explicit one
+        if 'charset' not in response.headers.get('content-type', '').lower():
+            return None
+        return self._lookup_encoding(requests.utils.get_encoding_from_headers(response.headers))
+    
+    def _sniff_encoding(self, head: bytes, header_encoding: Optional[str]) -> Optional[str]:
+        """
+        Pick the page encoding: BOM, then HTTP charset, then declared charset.
+        
+        Returns None if none of these has been found in the bytes so far.
+        """
+        _, bom_encoding = EncodingDetector.strip_byte_order_mark(head)
+        if bom_encoding:
+            return _BOM_CODECS.get(bom_encoding, bom_encoding)
+        if header_encoding:
+            return header_encoding
+        
+        declared = EncodingDetector.find_declared_encoding(head, is_html=True, search_entire_document=True)
+        return self._lookup_encoding(declared)
+    
+    def _lookup_encoding(self, name: Optional[str]) -> Optional[str]:
+        """Normalize an encoding name, or return None if Python doesn't know it."""
+        if not name:
+            return None
+        try:
+            return codecs.lookup(name).name
+        except LookupError:
+            self.logger.warning(f"Unknown encoding '{name}', ignoring it")
+            return None
     
-    def _process_table(self, table) -> List[Dict[str, Any]]:
+    def _process_table(self, table: etree._Element) -> List[Dict[str, Any]]:
         """Process a single table and extract relevant data."""
         data = []
         
         # Check if this table contains payment data by looking for specific patterns
-        table_text = table.get_text().lower()
+        table_text = _text_content(table).lower()
         if not self._is_payment_table(table_text):
             return data
         
+        all_rows = list(table.iter('tr'))
+        
         # Find header row
         header_row = None
         headers = []
         
         # Try to find headers in th tags first, then bold text, then first row
-        for row in table.find_all('tr'):
-            th_cells = row.find_all('th')
+        for row in all_rows:
+            th_cells = _th_cells(row)
             if th_cells:
-                headers = [self._clean_text(cell.get_text()) for cell in th_cells]
+                headers = [self._clean_text(_text_content(cell)) for cell in th_cells]
                 header_row = row
                 break
             
             # Check for bold headers in td tags (common in this type of page)
-            td_cells = row.find_all('td')
+            td_cells = _td_cells(row)
             if td_cells:
-                bold_count = sum(1 for cell in td_cells if cell.find('b') or 'font-weight:bold' in str(cell))
-                if bold_count > 0 or self._contains_header_keywords([self._clean_text(cell.get_text()) for cell in td_cells]):
-                    headers = [self._clean_text(cell.get_text()) for cell in td_cells]
+                cell_texts = [self._clean_text(_text_content(cell)) for cell in td_cells]
+                bold_count = sum(1 for cell in td_cells if cell.find('.//b') is not None
+                                 or 'font-weight:bold' in etree.tostring(cell, encoding='unicode', with_tail=False))
+                if bold_count > 0 or self._contains_header_keywords(cell_texts):
+                    headers = cell_texts
                     header_row = row
                     break
         
@@ -120,23 +247,22 @@ class PaymentDataScraper:
         column_mapping = self._map_headers_to_targets(headers)
         
         # Only process tables that have at least 3 of our target columns
-        if sum(1 for v in column_mapping.values() if v) < 3:
+        if len(column_mapping) < 3:
             return data
         
+        # Only mapped cells are ever read, so resolve them once per table
+        mapped_columns = sorted(column_mapping.items())
+        
         # Extract data rows
-        all_rows = table.find_all('tr')
-        data_rows = all_rows[1:] if header_row else all_rows
+        data_rows = all_rows[1:] if header_row is not None else all_rows
         
         for row in data_rows:
-            cells = row.find_all(['td', 'th'])
+            cells = _row_cells(row)
             if len(cells) == len(headers):
                 row_data = {}
-                
-                for i, cell in enumerate(cells):
-                    cell_text = self._clean_text(cell.get_text())
-                    target_column = column_mapping.get(i)
-                    
-                    if target_column and cell_text and cell_text != '':
+                for i, target_column in mapped_columns:
+                    cell_text = self._clean_text(_text_content(cells[i]))
+                    if cell_text:
                         row_data[target_column] = cell_text
                 
                 # Only add row if it has at least 3 target columns with data and is not a summary row
@@ -154,8 +280,13 @@ class PaymentDataScraper:
     
     def _is_payment_table(self, table_text: str) -> bool:
         """Check if table contains payment transaction data."""
-        payment_indicators = ['receipt', 'date', 'principal', 'collector', 'pen', 'cbu', 'payment', 'amount paid']
-        return sum(1 for indicator in payment_indicators if indicator in table_text) >= 4
+        found = 0
+        for indicator in _PAYMENT_INDICATORS:
+            if indicator in table_text:
+                found += 1
+                if found >= 4:
+                    return True
+        return False
     
     def _contains_header_keywords(self, headers: List[str]) -> bool:
         """Check if headers contain our target keywords."""
@@ -168,30 +299,18 @@ class PaymentDataScraper:
         all_values = ' '.join(str(v).lower() for v in row_data.values() if v)
         
         # Skip rows that contain summary/total keywords
-        summary_keywords = ['total', 'subtotal', 'grand total', 'sum', 'summary', 'balance']
-        if any(keyword in all_values for keyword in summary_keywords):
+        if _SUMMARY_RE.search(all_values):
             return False
         
         # Skip rows with only month names (like "April", "May", etc.)
-        month_names = ['january', 'february', 'march', 'april', 'may', 'june', 
-                      'july', 'august', 'september', 'october', 'november', 'december',
-                      'jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
-        if any(month in all_values for month in month_names) and len(row_data) < 4:
+        if len(row_data) < 4 and _MONTH_RE.search(all_values):
             return False
         
         # Check if the row has a valid date format
         date_value = row_data.get('Date', '').strip()
         if date_value:
             # Should look like a date (contains numbers and separators)
-            import re
-            # More flexible date pattern that allows various formats
-            date_patterns = [
-                r'\d+[/\-\.]\d+[/\-\.]\d+',  # DD/MM/YYYY, MM-DD-YYYY etc
-                r'\d{4}[/\-\.]\d{1,2}[/\-\.]\d{1,2}',  # YYYY-MM-DD
-                r'\d{1,2}\s+\w{3,9}\s+\d{4}',  # DD Month YYYY
-                r'\w{3,9}\s+\d{1,2},?\s+\d{4}',  # Month DD, YYYY
-            ]
-            if not any(re.search(pattern, date_value) for pattern in date_patterns):
+            if not any(pattern.search(date_value) for pattern in _DATE_PATTERNS):
                 # If it doesn't look like a proper date, skip it
                 return False
         
@@ -236,17 +355,20 @@ class PaymentDataScraper:
         
         return mapping
     
-    def _extract_from_structured_content(self, soup: BeautifulSoup) -> List[Dict[str, Any]]:
+    def _extract_from_structured_content(self, tree: etree._Element) -> List[Dict[str, Any]]:
         """Extract data from structured div/span elements as fallback."""
         data = []
         
-        # Look for divs or spans that might contain payment data
-        elements = soup.find_all(['div', 'span', 'p'])
+        # Script/style contents and comments are not page text
+        etree.strip_elements(tree, 'script', 'style', etree.Comment, with_tail=False)
+        
+        # Look for divs or spans that might contain payment data; only ones with a ':' can
+        elements = _key_value_elements(tree)
         
         current_record = {}
         
         for element in elements:
-            text = self._clean_text(element.get_text())
+            text = self._clean_text(_text_content(element))
             
             # Try to extract key-value pairs
             if ':' in text:
@@ -281,21 +403,6 @@ class PaymentDataScraper:
         text = ' '.join(text.split())
         
         # Remove common unwanted characters but keep useful ones
-        text = re.sub(r'[^\w\s\$€£¥.,:\-/()%]', '', text)
+        text = _CLEAN_RE.sub('', text)
         
         return text.strip()
-    
-    def _remove_duplicates(self, data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Remove duplicate records while preserving order."""
-        seen = set()
-        unique_data = []
-        
-        for item in data:
-            # Create a signature for the item
-            item_signature = tuple(sorted(item.items()))
-            
-            if item_signature not in seen:
-                seen.add(item_signature)
-                unique_data.append(item)
-        
-        return unique_data
\ No newline at end of file